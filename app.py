@@ -1,23 +1,102 @@
-import json
 import logging
-from datetime import datetime
+import os
+from datetime import datetime, timedelta
 
-from flask import Flask, Response, jsonify, render_template, request
+import orjson
+import redis
+from dotenv import load_dotenv
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    render_template,
+    request,
+    session,
+    stream_with_context,
+)
+from flask.json.provider import JSONProvider
+from flask_caching import Cache
+from flask_session import Session
+from rq import Queue, Retry
+
+from bot import chatbot_with_memory_json, chatbot_with_memory_sse
+from email_utils import send_email, write_conversation_for_email
+
+load_dotenv()
+
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider using orjson for request parsing and jsonify responses."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-from bot import chatbot_with_memory_json
-from email_utils import send_email
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Session data store - in a production app, use a proper session management system
-sessions = {}
+# Session data lives in Redis so any worker process can serve any request,
+# and abandoned chats expire on their own instead of piling up in memory
+SESSION_LIFETIME = timedelta(hours=2)
+
+redis_client = redis.Redis(
+    host=os.getenv("REDIS_HOST", "localhost"),
+    port=int(os.getenv("REDIS_PORT", 6379)),
+)
+
+app.config["SESSION_TYPE"] = "redis"
+app.config["SESSION_REDIS"] = redis_client
+app.config["PERMANENT_SESSION_LIFETIME"] = SESSION_LIFETIME
+Session(app)
+
+# Rendered pages are cached in the same Redis instance
+cache = Cache(
+    app,
+    config={
+        "CACHE_TYPE": "RedisCache",
+        "CACHE_REDIS_HOST": os.getenv("REDIS_HOST", "localhost"),
+        "CACHE_REDIS_PORT": int(os.getenv("REDIS_PORT", 6379)),
+        "CACHE_DEFAULT_TIMEOUT": 300,
+    },
+)
+
+# Transcript emails are sent by an RQ worker so /finish does not wait on
+# SMTP. Failed sends are retried on an interval, which RQ only does when a
+# worker runs the scheduler. Run it without forking so the SMTP connection
+# is reused across jobs:
+#   rq worker --with-scheduler --worker-class rq.worker.SimpleWorker
+email_queue = Queue(connection=redis_client)
+
+
+def history_key(sid: str) -> str:
+    """Redis key holding the conversation history for a session."""
+    return f"chat:{sid}"
+
+
+def load_history(sid: str) -> list:
+    """Load the conversation history stored for a session."""
+    raw = redis_client.hget(history_key(sid), "history")
+    return orjson.loads(raw) if raw else []
+
+
+def save_history(sid: str, history: list) -> None:
+    """Store the conversation history for a session, refreshing its TTL."""
+    key = history_key(sid)
+    pipe = redis_client.pipeline()
+    pipe.hset(key, "history", orjson.dumps(history))
+    pipe.expire(key, SESSION_LIFETIME)
+    pipe.execute()
 
 
 @app.route("/")
+@cache.cached(timeout=3600)
 def index():
     return render_template("index.html")
 
@@ -34,12 +113,13 @@ def start_chat():
         return jsonify({"error": "Email and phone are required"}), 400
 
     # Initialize session data
-    sessions[email] = {
+    session.permanent = True
+    session["data"] = {
         "email": email,
         "phone": phone,
-        "conversation_history": [],
         "start_time": datetime.now().isoformat(),
     }
+    save_history(session.sid, [])
 
     logger.info(f"Chat started for user: {email}")
     return jsonify({"status": "OK", "message": "User data received"})
@@ -55,131 +135,68 @@ def ask():
         logger.error("No query provided")
         return jsonify({"error": "No query"}), 400
 
-    if not email or email not in sessions:
+    session_data = session.get("data")
+    if not email or not session_data or session_data["email"] != email:
         logger.error(f"Invalid session or missing email: {email}")
         return jsonify({"error": "Invalid session"}), 400
 
     try:
-        conversation_history = sessions[email]["conversation_history"]
+        conversation_history = load_history(session.sid)
         # Use the NON-streaming version:
         answer_json = chatbot_with_memory_json(query, conversation_history)
+        save_history(session.sid, conversation_history)
         return jsonify(answer_json)
     except Exception as e:
         logger.error(f"Error generating response: {str(e)}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
 
-def format_conversation_for_email(conversation):
-    """Format conversation data for email transcript (plain text version)"""
-    transcript = "===== CHAT TRANSCRIPT =====\n\n"
-
-    for entry in conversation:
-        timestamp = entry.get("timestamp", "")
-        role = entry.get("role", "")
-        content = entry.get("content", "")
-
-        # Try to determine if content is JSON and format accordingly
-        try:
-            if (
-                role == "assistant"
-                and content.strip().startswith("{")
-                and content.strip().endswith("}")
-            ):
-                json_content = json.loads(content)
-                formatted_content = format_json_content(json_content)
-                content = formatted_content
-        except:
-            # If parsing fails, use the original content
-            pass
-
-        # Format based on role
-        if role == "user":
-            transcript += f"[USER] {timestamp}\n{content}\n\n"
-        elif role == "assistant":
-            transcript += f"[GITA] {timestamp}\n{content}\n\n"
-
-    transcript += "===== END OF TRANSCRIPT ====="
-    return transcript
-
-
-def format_html_conversation_for_email(conversation):
-    """Format conversation data for email transcript (HTML version)"""
-    transcript = "<h2>Chat Transcript</h2>"
-
-    for entry in conversation:
-        timestamp = entry.get("timestamp", "")
-        role = entry.get("role", "")
-        content = entry.get("content", "")
-
-        # Try to determine if content is JSON and format accordingly
-        try:
-            if (
-                role == "assistant"
-                and content.strip().startswith("{")
-                and content.strip().endswith("}")
-            ):
-                json_content = json.loads(content)
-                formatted_content = format_json_content_html(json_content)
-                content = formatted_content
-        except:
-            # If parsing fails, use the original content and escape HTML
-            content = (
-                content.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-            )
-            content = content.replace("\n", "<br>")
-
-        # Format based on role with different styling
-        if role == "user":
-            transcript += f'<div class="user-message"><p><strong>[USER]</strong> {timestamp}</p><p>{content}</p></div>'
-        elif role == "assistant":
-            transcript += f'<div class="bot-message"><p><strong>[GITA]</strong> {timestamp}</p><p>{content}</p></div>'
-
-    return transcript
-
-
-def format_json_content(json_data):
-    """Format JSON content for better readability in plain text emails"""
-    formatted = ""
-
-    if "title" in json_data and json_data["title"]:
-        formatted += f"--- {json_data['title']} ---\n\n"
-
-    if "paragraphs" in json_data and json_data["paragraphs"]:
-        for p in json_data["paragraphs"]:
-            formatted += f"{p}\n\n"
-
-    if "bullets" in json_data and json_data["bullets"]:
-        for i, b in enumerate(json_data["bullets"], 1):
-            formatted += f"{i}. {b}\n"
-        formatted += "\n"
-
-    if "info_lain" in json_data and json_data["info_lain"]:
-        formatted += f"Info Lain: {json_data['info_lain']}\n"
-
-    return formatted
-
-
-def format_json_content_html(json_data):
-    """Format JSON content for better readability in HTML emails"""
-    formatted = ""
-
-    if "title" in json_data and json_data["title"]:
-        formatted += f"<h3>{json_data['title']}</h3>"
+@app.route("/ask_stream", methods=["POST"])
+def ask_stream():
+    data = request.get_json()
+    query = data.get("query", "")
+    email = data.get("email", "")
 
-    if "paragraphs" in json_data and json_data["paragraphs"]:
-        for p in json_data["paragraphs"]:
-            formatted += f"<p>{p}</p>"
+    if not query:
+        logger.error("No query provided")
+        return jsonify({"error": "No query"}), 400
 
-    if "bullets" in json_data and json_data["bullets"]:
-        formatted += "<ul>"
-        for b in json_data["bullets"]:
-            formatted += f"<li>{b}</li>"
-        formatted += "</ul>"
+    session_data = session.get("data")
+    if not email or not session_data or session_data["email"] != email:
+        logger.error(f"Invalid session or missing email: {email}")
+        return jsonify({"error": "Invalid session"}), 400
 
-    if "info_lain" in json_data and json_data["info_lain"]:
-        formatted += f"<p> {json_data['info_lain']}</p>"
+    # The session cookie is already sent once streaming starts, so history
+    # is written to Redis directly when the stream finishes
+    sid = session.sid
+    conversation_history = load_history(sid)
 
-    return formatted
+    def generate():
+        try:
+            yield from chatbot_with_memory_sse(query, conversation_history)
+            save_history(sid, conversation_history)
+        except Exception as e:
+            logger.error(f"Error streaming response: {str(e)}")
+            error = {"error": f"Internal server error: {str(e)}"}
+            yield f"data: {orjson.dumps(error).decode()}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def is_valid_conversation(conversation) -> bool:
+    """Check that a conversation is a list of entries with string fields."""
+    return isinstance(conversation, list) and all(
+        isinstance(entry, dict)
+        and all(
+            isinstance(entry.get(field, ""), str)
+            for field in ("role", "content", "timestamp")
+        )
+        for entry in conversation
+    )
 
 
 @app.route("/finish", methods=["POST"])
@@ -190,8 +207,8 @@ def finish_chat():
     else:
         try:
             # Try to parse data from raw request body
-            data = json.loads(request.data.decode("utf-8"))
-        except:
+            data = orjson.loads(request.data)
+        except orjson.JSONDecodeError:
             logger.error("Unable to parse request data")
             return jsonify({"error": "Invalid data format", "status": "ERROR"}), 400
 
@@ -206,27 +223,39 @@ def finish_chat():
             400,
         )
 
-    # Format conversation for email
-    plain_transcript = format_conversation_for_email(conversation)
-    html_transcript = format_html_conversation_for_email(conversation)
+    # Formatting happens in the email worker after this request returns, so
+    # reject malformed transcripts here where the client can still see it
+    if not is_valid_conversation(conversation):
+        logger.error("Invalid conversation format")
+        return (
+            jsonify({"error": "Invalid conversation format", "status": "ERROR"}),
+            400,
+        )
 
-    # Send email with transcript
+    # Queue email with transcript
     try:
-        send_email(plain_transcript, email, phone, html_transcript=html_transcript)
-        logger.info(f"Chat transcript sent for user: {email}")
+        email_queue.enqueue(
+            send_email,
+            conversation,
+            email,
+            phone,
+            retry=Retry(max=3, interval=[10, 30, 60]),
+        )
+        logger.info(f"Chat transcript queued for user: {email}")
 
         # Clean up session if it exists
-        if email in sessions:
-            del sessions[email]
+        if session.get("data"):
+            redis_client.delete(history_key(session.sid))
+            session.clear()
 
         return jsonify(
             {
                 "status": "OK",
-                "message": "Chat ended & transcript sent via email successfully.",
+                "message": "Chat ended & transcript queued for email.",
             }
         )
     except Exception as e:
-        logger.error(f"Error sending email: {str(e)}")
+        logger.error(f"Error queueing email: {str(e)}")
 
         # Create a backup of the transcript
         try:
@@ -234,7 +263,7 @@ def finish_chat():
 
             backup_file = f"transcript_backup_{email}_{int(time.time())}.txt"
             with open(backup_file, "w") as f:
-                f.write(plain_transcript)
+                write_conversation_for_email(f, conversation)
             logger.info(f"Transcript backup saved to {backup_file}")
 
             return (
@@ -260,4 +289,6 @@ def finish_chat():
 
 
 if __name__ == "__main__":
+    # Development server only; in production run `gunicorn app:app`
+    # (settings in gunicorn.conf.py)
     app.run(debug=True)
@@ -1,13 +1,21 @@
-import json
+import hashlib
+import logging
 import os
 import time
+from functools import lru_cache
 from typing import Dict, Generator, List
 
-import requests
+import faiss
+import httpx
+import ijson
+import orjson
+import redis
 from dotenv import load_dotenv
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
 
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 api_key = os.getenv("KEY_API_OPENROUTER")
 if not api_key:
@@ -15,55 +23,193 @@ if not api_key:
         "API key not found. Please set KEY_API_OPENROUTER in your environment"
     )
 
-# Initialize embedding model & vector store
-embedding_model = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+# Initialize embedding model & vector store. A quantized ONNX export of the
+# model is used when present (see onnx_embeddings.py for how to build it).
+ONNX_EMBEDDING_PATH = os.getenv("ONNX_EMBEDDING_PATH", "onnx_minilm_int8")
+if os.path.isdir(ONNX_EMBEDDING_PATH):
+    from onnx_embeddings import ONNXMiniLMEmbeddings
+
+    embedding_model = ONNXMiniLMEmbeddings(ONNX_EMBEDDING_PATH)
+else:
+    embedding_model = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+# Warm up the model at import so the first request in each worker does not
+# pay for lazy initialization
+embedding_model.embed_query("warmup")
 vectorstore = FAISS.load_local(
     "faiss_index2",
     embedding_model,
     allow_dangerous_deserialization=True,
 )
+# Search on the GPU when faiss-gpu is installed and a device is present.
+# The resources object must stay alive as long as the GPU index does.
+if hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0:
+    gpu_resources = faiss.StandardGpuResources()
+    vectorstore.index = faiss.index_cpu_to_gpu(gpu_resources, 0, vectorstore.index)
+retriever = vectorstore.as_retriever(search_kwargs={"k": 4})
+
+# Retrieved context is cached in Redis so repeated questions skip the
+# embedding + FAISS search, shared across all worker processes
+CONTEXT_CACHE_TTL = 600
+redis_client = redis.Redis(
+    host=os.getenv("REDIS_HOST", "localhost"),
+    port=int(os.getenv("REDIS_PORT", 6379)),
+)
+
+# Shared HTTP/2 client so OpenRouter calls reuse pooled connections instead
+# of paying a TCP + TLS handshake on every request
+http_client = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    ),
+    timeout=60,
+)
+
+# The transport only retries failed connects; transient gateway errors from
+# OpenRouter are retried here with exponential backoff
+RETRY_STATUSES = {502, 503, 504}
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.3
+
+
+def post_with_retry(url: str, headers: Dict, payload: Dict) -> httpx.Response:
+    """POST a JSON payload, retrying 502/503/504 responses with backoff."""
+    for attempt in range(MAX_RETRIES + 1):
+        resp = http_client.post(url, headers=headers, json=payload)
+        if resp.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return resp
+        time.sleep(RETRY_BACKOFF * 2**attempt)
+
+
+SYSTEM_PROMPT = (
+    "Kamu adalah asisten AI bernama GITA yang dirancang untuk menjawab segala pertanyaan tentang perusahaan ini. "
+    "Bertindaklah sebagai customer service dan kamu merupakan bagian dari perusahaan kami! "
+    "Gunakan database yang tersedia untuk memberikan jawaban yang akurat dan relevan. "
+    "Jawablah secara alami, jelas, dan informatif dan Pastikan jawaban merupakan jawaban yang ringkas dan tidak terlalu panjang, tetapi tetap informatif dan menarik "
+    "Jawablah hanya dalam format JSON valid, "
+    "dengan struktur minimal sbb:\n"
+    "{\n"
+    '  "title": string,\n'
+    '  "paragraphs": ["...", "..."],\n'
+    '  "bullets": ["...", "..."],\n'
+    '  "info_lain": " "\n'
+    "}\n"
+    "Pastikan output benar-benar JSON (tanpa tambahan kata lain di luar JSON). "
+    "Jangan gunakan emot atau kalimat di luar struktur JSON."
+)
+
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+SUMMARY_PROMPT = (
+    "Ringkas percakapan berikut antara pengguna dan GITA secara singkat. "
+    "Pertahankan fakta penting, pertanyaan pengguna, "
+    "dan jawaban yang sudah diberikan."
+)
+
+# Only the most recent turns are sent with each question; once the history
+# grows past the threshold, older turns are folded into one summary message
+MAX_HISTORY_MESSAGES = 10
+SUMMARY_THRESHOLD = 20
+SUMMARY_MODEL = os.getenv(
+    "OPENROUTER_SUMMARY_MODEL", "meta-llama/llama-3.2-3b-instruct:free"
+)
 
 
 def get_relevant_context(query: str) -> str:
     """Get relevant document context for a query."""
-    retriever = vectorstore.as_retriever()
-    related_docs = retriever.invoke(query)
-    return "\n".join(doc.page_content for doc in related_docs)
+    return _lookup_context(query.strip().lower())
+
+
+@lru_cache(maxsize=1024)
+def _lookup_context(normalized_query: str) -> str:
+    """Look up context for a normalized query, checking Redis before FAISS."""
+    key = f"ctx:{hashlib.sha1(normalized_query.encode()).hexdigest()}"
+    try:
+        cached = redis_client.get(key)
+        if cached is not None:
+            return cached.decode("utf-8")
+    except redis.RedisError as e:
+        logger.warning(f"Context cache unavailable: {str(e)}")
+
+    related_docs = retriever.invoke(normalized_query)
+    context = "\n".join(doc.page_content for doc in related_docs)
+
+    try:
+        redis_client.setex(key, CONTEXT_CACHE_TTL, context)
+    except redis.RedisError as e:
+        logger.warning(f"Failed to cache context: {str(e)}")
+
+    return context
 
 
 def prepare_messages(
     query: str, conversation_history: List[Dict], context: str
 ) -> List[Dict]:
     """Prepare messages for the API call."""
-    system_prompt = (
-        "Kamu adalah asisten AI bernama GITA yang dirancang untuk menjawab segala pertanyaan tentang perusahaan ini. "
-        "Bertindaklah sebagai customer service dan kamu merupakan bagian dari perusahaan kami! "
-        "Gunakan database yang tersedia untuk memberikan jawaban yang akurat dan relevan. "
-        "Jawablah secara alami, jelas, dan informatif dan Pastikan jawaban merupakan jawaban yang ringkas dan tidak terlalu panjang, tetapi tetap informatif dan menarik "
-        "Jawablah hanya dalam format JSON valid, "
-        "dengan struktur minimal sbb:\n"
-        "{\n"
-        '  "title": string,\n'
-        '  "paragraphs": ["...", "..."],\n'
-        '  "bullets": ["...", "..."],\n'
-        '  "info_lain": " "\n'
-        "}\n"
-        "Pastikan output benar-benar JSON (tanpa tambahan kata lain di luar JSON). "
-        "Jangan gunakan emot atau kalimat di luar struktur JSON."
-    )
-
-    messages = [{"role": "system", "content": system_prompt}]
-    # Add previous conversation to messages
-    messages.extend(conversation_history)
-    # Add user message with context + query
-    messages.append(
+    # Keep the running summary (if any) ahead of the most recent turns
+    summary = conversation_history[:1]
+    if summary and summary[0]["role"] != "system":
+        summary = []
+    recent_start = max(len(summary), len(conversation_history) - MAX_HISTORY_MESSAGES)
+
+    return [
+        SYSTEM_MESSAGE,
+        *summary,
+        *conversation_history[recent_start:],
+        # Add user message with context + query
         {
             "role": "user",
             "content": f"Informasi database:\n{context}\n\nPertanyaan: {query}",
-        }
-    )
+        },
+    ]
 
-    return messages
+
+def summarize_history(conversation_history: List[Dict]) -> None:
+    """
+    Replace older turns with a single summary message, in place,
+    once the history is longer than SUMMARY_THRESHOLD.
+    """
+    if len(conversation_history) <= SUMMARY_THRESHOLD:
+        return
+
+    older = conversation_history[:-MAX_HISTORY_MESSAGES]
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in older)
+
+    url = "https://openrouter.ai/api/v1/chat/completions"
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    }
+    payload = {
+        "model": SUMMARY_MODEL,
+        "messages": [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ],
+        "stream": False,
+        "temperature": 0.2,
+    }
+
+    try:
+        resp = post_with_retry(url, headers, payload)
+        resp.raise_for_status()
+        summary = resp.json()["choices"][0]["message"]["content"]
+    except (httpx.HTTPError, ValueError, KeyError, IndexError) as e:
+        # Drop the older turns anyway (keeping any earlier summary) so the
+        # stored history stays bounded and the next attempt is only made
+        # once it has grown past the threshold again
+        logger.warning(f"Failed to summarize conversation history: {str(e)}")
+        keep = 1 if conversation_history[0]["role"] == "system" else 0
+        del conversation_history[keep:-MAX_HISTORY_MESSAGES]
+        return
+
+    conversation_history[:-MAX_HISTORY_MESSAGES] = [
+        {
+            "role": "system",
+            "content": f"Ringkasan percakapan sebelumnya:\n{summary}",
+        }
+    ]
 
 
 def chatbot_with_memory_json(
@@ -79,6 +225,9 @@ def chatbot_with_memory_json(
     # Get relevant context
     context = get_relevant_context(query)
 
+    # Keep the history sent to the model bounded
+    summarize_history(conversation_history)
+
     # Prepare messages
     messages = prepare_messages(query, conversation_history, context)
 
@@ -97,16 +246,16 @@ def chatbot_with_memory_json(
         "frequency_penalty": 0.5,
     }
 
-    resp = requests.post(url, headers=headers, json=payload)
+    resp = post_with_retry(url, headers, payload)
     data = resp.json()
 
-    # Get answer text (should be JSON string)
-    answer_text = data["choices"][0]["message"]["content"]
+    # Get answer text (should be JSON string, possibly in a code fence)
+    answer_text = _strip_code_fence(data["choices"][0]["message"]["content"])
     # print(f"Response from API: {answer_text}")
 
     # Try to parse JSON
     try:
-        answer_json = json.loads(answer_text)
+        answer_json = orjson.loads(answer_text)
         # print(f"Parsed JSON: {answer_json}")
     except Exception as e:
         # Fallback if parsing fails
@@ -122,23 +271,17 @@ def chatbot_with_memory_json(
     return answer_json
 
 
-def chatbot_with_memory_json_stream(
-    query: str, conversation_history: List[Dict] = None
-) -> Generator[Dict, None, None]:
-    """
-    Streaming version of the chatbot.
-    Yields partial JSON objects as they are received.
-    """
-    if conversation_history is None:
-        conversation_history = []
-
+def _prepare_stream_request(query: str, conversation_history: List[Dict]) -> tuple:
+    """Build the URL, headers and payload for a streaming chat request."""
     # Get relevant context
     context = get_relevant_context(query)
 
+    # Keep the history sent to the model bounded
+    summarize_history(conversation_history)
+
     # Prepare messages
     messages = prepare_messages(query, conversation_history, context)
 
-    # Make streaming request
     url = "https://openrouter.ai/api/v1/chat/completions"
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -153,11 +296,75 @@ def chatbot_with_memory_json_stream(
         "presence_penalty": 0.5,
         "frequency_penalty": 0.5,
     }
+    return url, headers, payload
+
+
+def _delta_content(data: str) -> str:
+    """Extract the text delta from one SSE data payload."""
+    try:
+        chunk = orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # Skip invalid JSON
+        return ""
+    delta = chunk.get("choices", [{}])[0].get("delta", {})
+    return delta.get("content") or ""
+
+
+def chatbot_with_memory_json_stream(
+    query: str, conversation_history: List[Dict] = None
+) -> Generator[Dict, None, None]:
+    """
+    Streaming version of the chatbot.
+    Yields partial JSON objects as they are received.
+    """
+    if conversation_history is None:
+        conversation_history = []
+
+    url, headers, payload = _prepare_stream_request(query, conversation_history)
+
+    # Stream the response to handle SSE
+    with http_client.stream("POST", url, headers=headers, json=payload) as response:
+        yield from _process_stream(response, query, conversation_history)
 
-    # Use stream=True for requests to handle SSE
-    response = requests.post(url, headers=headers, json=payload, stream=True)
 
+def chatbot_with_memory_sse(
+    query: str, conversation_history: List[Dict] = None
+) -> Generator[str, None, None]:
+    """
+    Pass-through streaming version of the chatbot.
+    Yields the OpenRouter SSE lines unchanged; the answer is only
+    assembled once the stream ends, to record conversation history.
+    """
+    if conversation_history is None:
+        conversation_history = []
+
+    url, headers, payload = _prepare_stream_request(query, conversation_history)
+
+    data_lines = []
+    with http_client.stream("POST", url, headers=headers, json=payload) as response:
+        if response.status_code != 200:
+            response.read()
+            error = {"error": {"code": response.status_code, "message": response.text}}
+            yield f"data: {orjson.dumps(error).decode()}\n\n"
+            return
+
+        for line in response.iter_lines():
+            yield line + "\n"
+            if line.startswith("data: ") and line != "data: [DONE]":
+                data_lines.append(line[6:])
+
+    # Record conversation history
+    answer_text = "".join(_delta_content(data) for data in data_lines)
+    conversation_history.append({"role": "user", "content": query})
+    conversation_history.append({"role": "assistant", "content": answer_text})
+
+
+def _process_stream(
+    response: httpx.Response, query: str, conversation_history: List[Dict]
+) -> Generator[Dict, None, None]:
+    """Parse an OpenRouter SSE response into partial JSON objects."""
     if response.status_code != 200:
+        response.read()
         error_json = {
             "title": "Error",
             "paragraphs": [f"Error: {response.status_code}", response.text],
@@ -170,119 +377,90 @@ def chatbot_with_memory_json_stream(
     # Track conversation for history update
     conversation_history.append({"role": "user", "content": query})
 
-    # Process the streaming response
-    buffer = ""
+    # Process the streaming response, feeding the answer text to an
+    # incremental JSON parser so fields are filled in as they complete
+    buffer = []
     accumulated_json = {"title": "", "paragraphs": [], "bullets": [], "info_lain": ""}
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events)
+    parser_ok = True
+    json_started = False
 
     for line in response.iter_lines():
-        if line:
-            line = line.decode("utf-8")
+        # Skip lines that don't contain data
+        if not line.startswith("data: "):
+            continue
 
-            # Skip lines that don't contain data
-            if not line.startswith("data: "):
-                continue
+        # Extract the data part
+        data = line[6:]  # Remove 'data: ' prefix
 
-            # Extract the data part
-            data = line[6:]  # Remove 'data: ' prefix
+        # Skip [DONE] message
+        if data == "[DONE]":
+            break
 
-            # Skip [DONE] message
-            if data == "[DONE]":
-                break
+        # Extract text content
+        content = _delta_content(data)
+        if not content:
+            continue
 
-            try:
-                # Parse the JSON data
-                chunk = json.loads(data)
-
-                # Extract text content
-                delta = chunk.get("choices", [{}])[0].get("delta", {})
-                content = delta.get("content", "")
-
-                if content:
-                    buffer += content
-
-                    # Try to parse accumulated buffer as JSON
-                    try:
-                        # As we receive chunks, some might be partial JSON
-                        # We'll try to extract what we can from the buffer
-                        # and update our accumulated JSON
-
-                        # Simple approach: look for complete JSON fields
-                        if '"title":' in buffer and accumulated_json["title"] == "":
-                            # Try to extract title
-                            title_start = buffer.find('"title"') + 8
-                            title_end = buffer.find('"', title_start + 2)
-                            if title_end > title_start:
-                                accumulated_json["title"] = buffer[
-                                    title_start + 1 : title_end
-                                ]
-
-                        # Extract paragraphs (simplified approach)
-                        if '"paragraphs":' in buffer:
-                            para_match = buffer.find('"paragraphs"')
-                            if para_match > -1 and "]" in buffer[para_match:]:
-                                # Try to extract complete paragraphs array
-                                para_start = buffer.find("[", para_match)
-                                para_end = buffer.find("]", para_start)
-                                if para_end > para_start:
-                                    para_json = buffer[para_start : para_end + 1]
-                                    try:
-                                        paras = json.loads(para_json)
-                                        accumulated_json["paragraphs"] = paras
-                                    except:
-                                        pass
-
-                        # Extract bullets (simplified approach)
-                        if '"bullets":' in buffer:
-                            bullet_match = buffer.find('"bullets"')
-                            if bullet_match > -1 and "]" in buffer[bullet_match:]:
-                                # Try to extract complete bullets array
-                                bullet_start = buffer.find("[", bullet_match)
-                                bullet_end = buffer.find("]", bullet_start)
-                                if bullet_end > bullet_start:
-                                    bullet_json = buffer[bullet_start : bullet_end + 1]
-                                    try:
-                                        bullets = json.loads(bullet_json)
-                                        accumulated_json["bullets"] = bullets
-                                    except:
-                                        pass
-
-                        # Extract info_lain
-                        if '"info_lain":' in buffer:
-                            info_start = buffer.find('"info_lain"') + 12
-                            info_end = buffer.find('"', info_start + 2)
-                            if info_end > info_start:
-                                accumulated_json["info_lain"] = buffer[
-                                    info_start + 1 : info_end
-                                ]
-
-                        # See if we now have a complete JSON
-                        try:
-                            complete_json = json.loads(buffer)
-                            accumulated_json = complete_json  # If we parsed successfully, use the complete JSON
-                            # But still yield incremental updates
-                        except:
-                            # Continue accumulating parts
-                            pass
-
-                        # Yield the current state
-                        yield accumulated_json
-
-                    except json.JSONDecodeError:
-                        # Continue accumulating until we get valid JSON
-                        pass
-
-            except json.JSONDecodeError:
-                # Skip invalid JSON
+        buffer.append(content)
+
+        # Skip anything before the JSON object, e.g. a ```json code fence
+        if not json_started:
+            start = content.find("{")
+            if start == -1:
+                yield accumulated_json
                 continue
+            content = content[start:]
+            json_started = True
+
+        if parser_ok:
+            try:
+                parser.send(content.encode("utf-8"))
+            except ijson.JSONError:
+                # Invalid JSON or trailing text (e.g. a closing code fence);
+                # keep the fields found so far and rely on the final parse
+                parser_ok = False
+            _apply_parse_events(accumulated_json, events)
+            del events[:]
+
+        # Yield the current state
+        yield accumulated_json
 
     # Try to parse the complete buffer at the end
+    answer_text = _strip_code_fence("".join(buffer))
     try:
-        final_json = json.loads(buffer)
+        final_json = orjson.loads(answer_text)
         yield final_json
-        conversation_history.append({"role": "assistant", "content": buffer})
-    except json.JSONDecodeError:
+        conversation_history.append({"role": "assistant", "content": answer_text})
+    except orjson.JSONDecodeError:
         # If we still can't parse it, yield whatever we've accumulated
         yield accumulated_json
         conversation_history.append(
-            {"role": "assistant", "content": json.dumps(accumulated_json)}
+            {"role": "assistant", "content": orjson.dumps(accumulated_json).decode()}
         )
+
+
+def _strip_code_fence(text: str) -> str:
+    """Remove a surrounding Markdown code fence (e.g. ```json ... ```)."""
+    text = text.strip()
+    if not text.startswith("```"):
+        return text
+    # Drop the opening fence line, including any language tag
+    _, _, text = text.partition("\n")
+    text = text.rstrip()
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
+
+
+def _apply_parse_events(accumulated_json: Dict, events: List) -> None:
+    """Copy completed top-level string fields and list items into the result."""
+    for prefix, event, value in events:
+        if event != "string":
+            continue
+        key, _, item = prefix.partition(".")
+        if item == "item" and isinstance(accumulated_json.get(key), list):
+            accumulated_json[key].append(value)
+        elif not item and key in accumulated_json:
+            accumulated_json[key] = value
@@ -1,10 +1,17 @@
+import io
 import logging
 import os
 import smtplib
+import threading
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from html.parser import HTMLParser
+from typing import TextIO
 
+import orjson
 from dotenv import load_dotenv
+from jinja2 import Environment, FileSystemLoader
+from markupsafe import escape
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -21,23 +28,222 @@ SMTP_USE_SSL = os.getenv("MAIL_ENCRYPTION", "ssl").lower() == "ssl"
 # Target email (company CS team) - customize as needed
 COMPANY_EMAIL = os.getenv("MAIL_FROM_ADDRESS", "cs@company.com")
 
+# HTML email template, compiled once at import
+_email_template = Environment(
+    loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), "templates")),
+    autoescape=True,
+).get_template("email.html")
+
+# Logged-in SMTP connection reused across emails sent by this process.
+# smtplib connections are not thread-safe, so all use goes through the lock.
+_smtp = None
+_smtp_lock = threading.Lock()
+
+
+def _connect_smtp() -> smtplib.SMTP:
+    """Open and authenticate a new SMTP connection."""
+    if SMTP_USE_SSL:
+        logger.info("Establishing SSL connection...")
+        server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=30)
+    else:
+        logger.info("Establishing standard connection...")
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
+        server.starttls()  # Use TLS for security
+
+    logger.info("Logging in to SMTP server...")
+    server.login(EMAIL_SENDER, EMAIL_PASSWORD)
+    return server
+
+
+def _close_smtp() -> None:
+    """Drop the cached SMTP connection, ignoring errors from a dead socket."""
+    global _smtp
+    if _smtp is not None:
+        try:
+            _smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        _smtp = None
+
+
+def _get_smtp() -> smtplib.SMTP:
+    """
+    Return the cached SMTP connection if it still answers NOOP,
+    otherwise reconnect. Must be called with _smtp_lock held.
+    """
+    global _smtp
+    if _smtp is not None:
+        try:
+            code, _ = _smtp.noop()
+            if 200 <= code < 300:
+                return _smtp
+        except (smtplib.SMTPException, OSError):
+            pass
+        _close_smtp()
+
+    _smtp = _connect_smtp()
+    return _smtp
+
+
+def parse_json_content(content):
+    """
+    Parse message content as a JSON object. Returns None if it is not one;
+    orjson rejects non-JSON text at the first bad byte, so no strip() or
+    brace check is needed first.
+    """
+    try:
+        json_content = orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return None
+    return json_content if isinstance(json_content, dict) else None
+
+
+class _AnswerHTMLSanitizer(HTMLParser):
+    """Keep the tags the chat widget renders answers with; escape the rest."""
+
+    ALLOWED_TAGS = {"h4", "p", "ul", "li", "br"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        # Attributes are always dropped
+        if tag in self.ALLOWED_TAGS:
+            self.parts.append(f"<{tag}>")
+
+    def handle_endtag(self, tag):
+        if tag in self.ALLOWED_TAGS and tag != "br":
+            self.parts.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        self.parts.append(str(escape(data)))
+
+
+def sanitize_answer_html(content):
+    """Sanitize assistant answer HTML stored by the chat widget for emails"""
+    parser = _AnswerHTMLSanitizer()
+    parser.feed(content)
+    parser.close()
+    return "".join(parser.parts)
+
+
+def write_conversation_for_email(out: TextIO, conversation: list) -> None:
+    """Write conversation data as a plain text email transcript to a text stream"""
+    out.write("===== CHAT TRANSCRIPT =====\n\n")
+
+    for entry in conversation:
+        timestamp = entry.get("timestamp", "")
+        role = entry.get("role", "")
+        content = entry.get("content", "")
+
+        # Format JSON answers; anything else keeps the original content
+        if role == "assistant":
+            json_content = parse_json_content(content)
+            if json_content is not None:
+                content = format_json_content(json_content)
+
+        # Format based on role
+        if role == "user":
+            out.write(f"[USER] {timestamp}\n{content}\n\n")
+        elif role == "assistant":
+            out.write(f"[GITA] {timestamp}\n{content}\n\n")
+
+    out.write("===== END OF TRANSCRIPT =====")
+
+
+def format_html_conversation_for_email(conversation):
+    """Format conversation data for email transcript (HTML version)"""
+    parts = ["<h2>Chat Transcript</h2>"]
+
+    for entry in conversation:
+        timestamp = escape(entry.get("timestamp", ""))
+        role = entry.get("role", "")
+        content = entry.get("content", "")
+
+        if role == "assistant":
+            # Format JSON answers; the chat widget stores rendered answers as
+            # HTML, so anything else keeps its allowed markup
+            json_content = parse_json_content(content)
+            if json_content is not None:
+                formatted_content = format_json_content_html(json_content)
+            else:
+                formatted_content = sanitize_answer_html(content)
+        else:
+            # Escape HTML in user messages
+            formatted_content = str(escape(content)).replace("\n", "<br>")
+
+        # Format based on role with different styling
+        if role == "user":
+            parts.append(
+                f'<div class="user-message"><p><strong>[USER]</strong> {timestamp}</p><p>{formatted_content}</p></div>'
+            )
+        elif role == "assistant":
+            parts.append(
+                f'<div class="bot-message"><p><strong>[GITA]</strong> {timestamp}</p><p>{formatted_content}</p></div>'
+            )
+
+    return "".join(parts)
+
+
+def format_json_content(json_data):
+    """Format JSON content for better readability in plain text emails"""
+    parts = []
+
+    if "title" in json_data and json_data["title"]:
+        parts.append(f"--- {json_data['title']} ---\n\n")
+
+    if "paragraphs" in json_data and json_data["paragraphs"]:
+        for p in json_data["paragraphs"]:
+            parts.append(f"{p}\n\n")
+
+    if "bullets" in json_data and json_data["bullets"]:
+        for i, b in enumerate(json_data["bullets"], 1):
+            parts.append(f"{i}. {b}\n")
+        parts.append("\n")
+
+    if "info_lain" in json_data and json_data["info_lain"]:
+        parts.append(f"Info Lain: {json_data['info_lain']}\n")
+
+    return "".join(parts)
+
+
+def format_json_content_html(json_data):
+    """Format JSON content for better readability in HTML emails"""
+    parts = []
+
+    if "title" in json_data and json_data["title"]:
+        parts.append(f"<h3>{escape(json_data['title'])}</h3>")
+
+    if "paragraphs" in json_data and json_data["paragraphs"]:
+        for p in json_data["paragraphs"]:
+            parts.append(f"<p>{escape(p)}</p>")
+
+    if "bullets" in json_data and json_data["bullets"]:
+        parts.append("<ul>")
+        for b in json_data["bullets"]:
+            parts.append(f"<li>{escape(b)}</li>")
+        parts.append("</ul>")
+
+    if "info_lain" in json_data and json_data["info_lain"]:
+        parts.append(f"<p> {escape(json_data['info_lain'])}</p>")
+
+    return "".join(parts)
+
 
 # Add better error handling and diagnostic information
-def send_email(
-    transcript: str, user_email: str, user_phone: str, html_transcript: str = None
-):
+def send_email(conversation: list, user_email: str, user_phone: str):
     """
     Send an email containing conversation transcript + user contact info
     to COMPANY_EMAIL (set in environment).
 
     Args:
-        transcript: Plain text transcript
+        conversation: Conversation entries with role, content and timestamp
         user_email: User's email address
         user_phone: User's phone number
-        html_transcript: HTML formatted transcript (optional)
     """
     # Validate parameters
-    if not transcript or not user_email or not user_phone:
+    if conversation is None or not user_email or not user_phone:
         error_msg = "Missing required parameters for email"
         logger.error(error_msg)
         raise ValueError(error_msg)
@@ -61,63 +267,40 @@ def send_email(
     msg["To"] = COMPANY_EMAIL
     msg["Subject"] = subject
 
-    # Create plain text version
-    plain_body = (
+    # Create plain text version, writing the transcript straight after the
+    # contact header instead of formatting it separately and concatenating
+    plain_body = io.StringIO()
+    plain_body.write(
         f"User Email   : {user_email}\n"
         f"User Phone   : {user_phone}\n"
         f"{'-'*40}\n\n"
-        f"{transcript}"
     )
+    write_conversation_for_email(plain_body, conversation)
 
     # Attach plain text part
-    msg.attach(MIMEText(plain_body, "plain"))
-
-    # Attach HTML part if provided
-    if html_transcript:
-        # Create HTML version with basic styling
-        html_body = f"""
-        <html>
-        <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; margin: 0; padding: 20px; color: #333; }}
-                .header {{ background-color: #007bff; color: white; padding: 15px; border-radius: 5px; }}
-                .user-info {{ background-color: #f8f9fa; padding: 15px; margin: 20px 0; border-left: 5px solid #007bff; }}
-                .transcript {{ background-color: #f8f9fa; padding: 15px; border-radius: 5px; }}
-                .user-message {{ background-color: #e3f2fd; padding: 10px; border-radius: 5px; margin: 10px 0; }}
-                .bot-message {{ background-color: #f1f8e9; padding: 10px; border-radius: 5px; margin: 10px 0; }}
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <h2>GITA Chatbot Transcript</h2>
-            </div>
-            <div class="user-info">
-                <p><strong>User Email:</strong> {user_email}</p>
-                <p><strong>User Phone:</strong> {user_phone}</p>
-            </div>
-            <div class="transcript">
-                {html_transcript}
-            </div>
-        </body>
-        </html>
-        """
-        msg.attach(MIMEText(html_body, "html"))
+    msg.attach(MIMEText(plain_body.getvalue(), "plain"))
+
+    # Render HTML version from the precompiled template
+    html_body = _email_template.render(
+        user_email=user_email,
+        user_phone=user_phone,
+        transcript=format_html_conversation_for_email(conversation),
+    )
+    msg.attach(MIMEText(html_body, "html"))
 
     try:
-        if SMTP_USE_SSL:
-            logger.info("Establishing SSL connection...")
-            server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=30)
-        else:
-            logger.info("Establishing standard connection...")
-            server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
-            server.starttls()  # Use TLS for security
-
-        logger.info("Logging in to SMTP server...")
-        server.login(EMAIL_SENDER, EMAIL_PASSWORD)
-        logger.info("Sending email...")
-        server.send_message(msg)
+        with _smtp_lock:
+            try:
+                logger.info("Sending email...")
+                _get_smtp().send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # Server dropped the connection between NOOP and send; retry once
+                _close_smtp()
+                _get_smtp().send_message(msg)
+            except Exception:
+                _close_smtp()
+                raise
         logger.info("Email sent successfully!")
-        server.quit()
 
         logger.info(f"Transcript successfully sent to company email: {COMPANY_EMAIL}")
         return True
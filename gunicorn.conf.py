@@ -0,0 +1,13 @@
+# Gunicorn settings, picked up automatically by: gunicorn app:app
+#
+# gevent workers let each process keep serving other requests while it
+# waits on OpenRouter, Redis or SMTP. Sessions live in Redis, so any worker
+# can serve any request.
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+worker_class = "gevent"
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+worker_connections = 1000
+timeout = 120
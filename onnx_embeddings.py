@@ -0,0 +1,61 @@
+"""
+INT8-quantized ONNX Runtime embeddings for all-MiniLM-L6-v2.
+
+Produces the same mean-pooled, L2-normalized vectors as the
+sentence-transformers model the FAISS index was built with. Export and
+quantize the model once with:
+
+    optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 \
+        --optimize O3 onnx_minilm/
+    optimum-cli onnxruntime quantize --onnx_model onnx_minilm \
+        --avx512_vnni -o onnx_minilm_int8
+
+Requires `pip install optimum[onnxruntime]`.
+"""
+
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from optimum.onnxruntime import ORTModelForFeatureExtraction
+from transformers import AutoTokenizer
+
+
+class ONNXMiniLMEmbeddings(Embeddings):
+    """LangChain embeddings backed by a quantized MiniLM ONNX model."""
+
+    def __init__(
+        self,
+        model_path: str,
+        file_name: str = "model_quantized.onnx",
+        tokenizer_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        max_length: int = 256,
+    ):
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_path, file_name=file_name
+        )
+        self.max_length = max_length
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        inputs = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="np",
+        )
+        token_embeddings = self.model(**inputs).last_hidden_state
+
+        # Mean pooling over non-padding tokens, then L2 normalization
+        mask = inputs["attention_mask"][..., np.newaxis].astype(np.float32)
+        summed = (token_embeddings * mask).sum(axis=1)
+        embeddings = summed / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.clip(norms, 1e-12, None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0].tolist()